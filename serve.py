@@ -5,64 +5,361 @@ Shamon Web Server
 Provides HTTP endpoints to view music recognition data from the SQLite database
 """
 
-from fastapi import FastAPI, Response, HTTPException
-from typing import List, Dict, Any
-import sqlite3
+import asyncio
+from contextlib import asynccontextmanager
+from datetime import datetime
+from fastapi import FastAPI, Response, HTTPException, Request, Depends, Query
+from fastapi.exception_handlers import http_exception_handler, request_validation_exception_handler
+from fastapi.exceptions import RequestValidationError
+from fastapi.responses import HTMLResponse, JSONResponse, StreamingResponse
+from fastapi.staticfiles import StaticFiles
+from typing import List, Dict, Any, AsyncIterator, Optional, Tuple
+import aiosqlite
 import os
+import time
 import uvicorn
+import hashlib
 import html as html_module
+import jinja2
+import orjson
+
+# Directory containing templates/ and static/
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# Database configuration
+DB_PATH = os.path.expanduser("~/.music_monitor.db")
+
+# Upper bound for the limit query parameter
+MAX_LIMIT = 1000
+
+# Rows pulled from the database thread per batch when iterating a cursor
+FETCH_CHUNK_SIZE = 128
+
+# Queries are module constants so every call passes byte-identical SQL and
+# hits sqlite3's per-connection prepared statement cache. SONGS_SQL orders by
+# songs.timestamp because a bare "timestamp" resolves to the localtime alias,
+# which can't use idx_songs_timestamp and forces a temp B-tree sort. Rows are
+# paged by the raw stored (timestamp, rowid): several songs can share the same
+# second, and converting the localtime display value back to UTC isn't exact
+# during the DST fall-back hour.
+SONGS_SQL = """
+SELECT
+    datetime(timestamp, 'localtime') as timestamp,
+    title,
+    artist,
+    audio_level,
+    rowid as id,
+    songs.timestamp as sort_ts
+FROM songs
+WHERE (songs.timestamp, songs.rowid) < (COALESCE(:before, '9999-12-31'), :before_id)
+ORDER BY songs.timestamp DESC, songs.rowid DESC
+LIMIT :limit
+"""
+
+STATS_SQL = """
+WITH top AS (
+    SELECT title, artist, COUNT(*) as count
+    FROM songs
+    GROUP BY title, artist
+    ORDER BY count DESC
+    LIMIT 1
+)
+SELECT
+    (SELECT COUNT(*) FROM songs),
+    (SELECT COUNT(*) FROM (SELECT 1 FROM songs GROUP BY title, artist)),
+    (SELECT datetime(MAX(timestamp), 'localtime') FROM songs),
+    (SELECT title FROM top),
+    (SELECT artist FROM top),
+    (SELECT count FROM top)
+"""
+
+# Changes whenever shamon.sh inserts a song; used to derive response ETags
+ETAG_SQL = "SELECT MAX(timestamp), COUNT(*) FROM songs"
+
+# Response cache configuration (shamon.sh inserts at most one row per song,
+# so polling clients can safely be served slightly stale data)
+CACHE_TTL = 5  # seconds
+CACHE_CONTROL = f"max-age={CACHE_TTL}"
+
+_response_cache: Dict[Tuple[Any, ...], Tuple[float, Any]] = {}
+
+
+def cache_get(key: Tuple[Any, ...]) -> Optional[Any]:
+    """Return a cached value, or None if missing or expired"""
+    entry = _response_cache.get(key)
+    if entry is None or entry[0] < time.monotonic():
+        return None
+    return entry[1]
+
+
+def cache_set(key: Tuple[Any, ...], value: Any) -> None:
+    """Cache a value for CACHE_TTL seconds, dropping expired entries"""
+    now = time.monotonic()
+    for expired in [k for k, (expires, _) in _response_cache.items() if expires < now]:
+        del _response_cache[expired]
+    _response_cache[key] = (now + CACHE_TTL, value)
+
+
+async def open_db_connection() -> Optional[aiosqlite.Connection]:
+    """Open the shared database connection used by all requests
+
+    Returns:
+        The connection, or None if shamon.sh hasn't created the songs table yet
+    """
+    db = await aiosqlite.connect(DB_PATH, iter_chunk_size=FETCH_CHUNK_SIZE)
+    try:
+        db.row_factory = aiosqlite.Row
+
+        # WAL lets readers run alongside shamon.sh inserts; the larger page cache
+        # and mmap window keep hot pages in memory across requests
+        await db.executescript(
+            """
+            PRAGMA journal_mode=WAL;
+            PRAGMA synchronous=NORMAL;
+            PRAGMA cache_size=-64000;
+            PRAGMA temp_store=MEMORY;
+            PRAGMA mmap_size=268435456;
+            """
+        )
+
+        async with db.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'songs'"
+        ) as cursor:
+            has_songs_table = await cursor.fetchone() is not None
+        if not has_songs_table:
+            await db.close()
+            return None
+
+        # Index the ORDER BY timestamp DESC, rowid DESC LIMIT ? hot path so it
+        # becomes an index range scan instead of a full scan plus temp B-tree
+        # sort. The index is ascending on purpose: walked backwards it yields
+        # (timestamp DESC, rowid DESC), which a DESC index can't.
+        await db.executescript(
+            """
+            CREATE INDEX IF NOT EXISTS idx_songs_timestamp ON songs(timestamp);
+            ANALYZE songs;
+            """
+        )
+    except BaseException:
+        await db.close()
+        raise
+    return db
+
+
+class OrjsonResponse(JSONResponse):
+    """JSON response encoded with orjson instead of the stdlib json module
+
+    Equivalent to FastAPI's ORJSONResponse, which newer FastAPI releases
+    deprecate with a runtime warning.
+    """
+
+    def render(self, content: Any) -> bytes:
+        return orjson.dumps(content)
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI) -> AsyncIterator[None]:
+    """Open the database connection on startup and close it on shutdown"""
+    # Don't create an empty database if shamon.sh hasn't run yet;
+    # get_db() connects lazily once the file and songs table exist.
+    app.state.db = await open_db_connection() if os.path.exists(DB_PATH) else None
+    try:
+        yield
+    finally:
+        if app.state.db is not None:
+            await app.state.db.close()
+
 
 app = FastAPI(
     title="Shamon Music Data API",
     description="Web API for viewing music recognition history",
-    version="1.2.3"
+    version="1.2.3",
+    lifespan=lifespan,
+    default_response_class=OrjsonResponse
 )
 
-# Database configuration
-DB_PATH = os.path.expanduser("~/.music_monitor.db")
 
+class ImmutableStaticFiles(StaticFiles):
+    """Static files served with a long-lived Cache-Control header
+
+    Assets are referenced with a ?v=<version> query string, so browsers can
+    keep them for a year and still pick up changes on upgrade.
+    """
+
+    def file_response(self, *args: Any, **kwargs: Any) -> Response:
+        response = super().file_response(*args, **kwargs)
+        response.headers["Cache-Control"] = "public, max-age=31536000, immutable"
+        return response
+
+
+app.mount("/static", ImmutableStaticFiles(directory=os.path.join(BASE_DIR, "static")), name="static")
+
+
+def table_error_page(status_code: int, message: str, headers: Optional[Dict[str, str]] = None) -> HTMLResponse:
+    """Build the HTML error page returned for /table errors"""
+    return HTMLResponse(
+        content=f"<html><body><h1>Error</h1><p>{html_module.escape(message)}</p></body></html>",
+        status_code=status_code,
+        headers=headers
+    )
+
+
+@app.exception_handler(HTTPException)
+async def table_http_exception_handler(request: Request, exc: HTTPException) -> Response:
+    """Render /table errors as an HTML page, whichever dependency raised them"""
+    if request.url.path != "/table" or exc.status_code < 400:
+        return await http_exception_handler(request, exc)
+    return table_error_page(exc.status_code, str(exc.detail), exc.headers)
+
+
+@app.exception_handler(RequestValidationError)
+async def table_validation_exception_handler(request: Request, exc: RequestValidationError) -> Response:
+    """Render /table query parameter errors (e.g. limit out of range) as an HTML page"""
+    if request.url.path != "/table":
+        return await request_validation_exception_handler(request, exc)
+    message = "; ".join(f"{error['loc'][-1]}: {error['msg']}" for error in exc.errors())
+    return table_error_page(422, message)
+
+
+# Serializes the lazy connect in get_db() so concurrent first requests
+# don't each open (and leak) a connection
+_db_connect_lock = asyncio.Lock()
+
+
+async def get_db(request: Request) -> aiosqlite.Connection:
+    """Return the shared database connection"""
+    if request.app.state.db is None:
+        async with _db_connect_lock:
+            if request.app.state.db is None:
+                if not os.path.exists(DB_PATH):
+                    raise HTTPException(
+                        status_code=503,
+                        detail=f"Database not found at {DB_PATH}. Run shamon.sh first to create the database."
+                    )
+                db = await open_db_connection()
+                if db is None:
+                    raise HTTPException(
+                        status_code=503,
+                        detail=f"Database at {DB_PATH} has no songs table yet. Run shamon.sh first to create it."
+                    )
+                request.app.state.db = db
+    return request.app.state.db
+
+
+async def check_etag(request: Request, db: aiosqlite.Connection = Depends(get_db)) -> str:
+    """Return the ETag for the current song data
+
+    Raises a 304 Not Modified response if the client already has it, so
+    unchanged data is never queried, serialized or rendered again.
+    """
+    try:
+        async with db.execute(ETAG_SQL) as cursor:
+            last_timestamp, count = await cursor.fetchone()
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+    digest = hashlib.md5(f"{request.app.version}:{last_timestamp}:{count}".encode()).hexdigest()
+    etag = f'"{digest}"'
+
+    if_none_match = request.headers.get("if-none-match", "")
+    client_etags = [tag.strip().removeprefix("W/") for tag in if_none_match.split(",")]
+    if etag in client_etags or "*" in client_etags:
+        raise HTTPException(status_code=304, headers={"ETag": etag, "Cache-Control": CACHE_CONTROL})
+    return etag
+
+
+def parse_before(before: Optional[str] = None) -> Optional[Tuple[str, int]]:
+    """Parse the ?before= keyset cursor
 
-def get_db_connection():
-    """Create and return a database connection"""
-    if not os.path.exists(DB_PATH):
+    Args:
+        before: The X-Next-Before value: stored (UTC) timestamp
+                (YYYY-MM-DD HH:MM:SS), optionally followed by ",<id>"
+
+    Returns:
+        (timestamp, id) tuple, or None when not paging
+    """
+    if before is None:
+        return None
+
+    timestamp, _, song_id = before.partition(",")
+    try:
+        # strptime also accepts unpadded fields; normalize so the string
+        # compares correctly against the stored timestamps
+        timestamp = datetime.strptime(timestamp, "%Y-%m-%d %H:%M:%S").strftime("%Y-%m-%d %H:%M:%S")
+        # A bare timestamp (id 0) returns songs strictly before that second
+        before_id = int(song_id) if song_id else 0
+    except ValueError:
+        before_id = -1
+    if before_id < 0:
         raise HTTPException(
-            status_code=503,
-            detail=f"Database not found at {DB_PATH}. Run shamon.sh first to create the database."
+            status_code=422,
+            detail="before must be 'YYYY-MM-DD HH:MM:SS', optionally followed by ',<id>' as in X-Next-Before"
         )
-    return sqlite3.connect(DB_PATH)
+    return timestamp, before_id
 
 
-def query_songs(limit: int = 100) -> List[Dict[str, Any]]:
-    """Query songs from the database
+async def execute_songs_query(
+    db: aiosqlite.Connection, limit: int, before: Optional[Tuple[str, int]] = None
+) -> aiosqlite.Cursor:
+    """Execute the most-recent-songs query and return its open cursor
 
     Args:
+        db: Database connection
         limit: Maximum number of songs to return
+        before: Only return songs older than this (stored timestamp, id) cursor
 
     Returns:
-        List of song dictionaries with timestamp, title, artist, and audio_level
+        Cursor over timestamp, title, artist, audio_level, id, and sort_ts rows
     """
-    conn = get_db_connection()
-    conn.row_factory = sqlite3.Row
-    cursor = conn.cursor()
-
-    cursor.execute(
-        """
-        SELECT
-            datetime(timestamp, 'localtime') as timestamp,
-            title,
-            artist,
-            audio_level
-        FROM songs
-        ORDER BY timestamp DESC
-        LIMIT ?
-        """,
-        (limit,)
+    before_timestamp, before_id = before or (None, 0)
+    return await db.execute(
+        SONGS_SQL, {"limit": limit, "before": before_timestamp, "before_id": before_id}
     )
 
-    rows = cursor.fetchall()
-    conn.close()
 
-    return [dict(row) for row in rows]
+async def query_songs_dicts(
+    db: aiosqlite.Connection, limit: int = 100, before: Optional[Tuple[str, int]] = None
+) -> Tuple[List[Dict[str, Any]], Optional[str]]:
+    """Query songs from the database as dictionaries (for JSON output)
+
+    Args:
+        db: Database connection
+        limit: Maximum number of songs to return
+        before: Only return songs older than this (stored timestamp, id) cursor
+
+    Returns:
+        List of song dictionaries with timestamp, title, artist, audio_level,
+        and id, plus the "<timestamp>,<id>" cursor for the next page (None if
+        this page wasn't full)
+    """
+    songs = []
+    sort_ts = None
+    async with await execute_songs_query(db, limit, before) as cursor:
+        async for row in cursor:
+            song = dict(row)
+            sort_ts = song.pop("sort_ts")
+            songs.append(song)
+
+    next_before = f"{sort_ts},{songs[-1]['id']}" if len(songs) == limit else None
+    return songs, next_before
+
+
+async def query_songs_tuples(db: aiosqlite.Connection, limit: int = 100) -> List[Tuple[Any, ...]]:
+    """Query songs from the database as plain tuples (for HTML output)
+
+    The column order is fixed, so skipping the Row factory avoids building
+    a Row and a dict per song just to read the known fields back out.
+
+    Args:
+        db: Database connection
+        limit: Maximum number of songs to return
+
+    Returns:
+        List of (timestamp, title, artist, audio_level, id, sort_ts) tuples
+    """
+    async with await execute_songs_query(db, limit) as cursor:
+        cursor.row_factory = None
+        return await cursor.fetchall()
 
 
 @app.get("/")
@@ -80,210 +377,132 @@ def root():
 
 
 @app.get("/json")
-def get_music_data(limit: int = 100):
+async def get_music_data(
+    response: Response,
+    limit: int = Query(100, ge=1, le=MAX_LIMIT),
+    before: Optional[Tuple[str, int]] = Depends(parse_before),
+    db: aiosqlite.Connection = Depends(get_db),
+    etag: str = Depends(check_etag)
+):
     """Get music data as JSON
 
+    Pages backwards through history with a keyset cursor: when a full page
+    is returned, the X-Next-Before header holds the value to pass as
+    ?before= for the next page.
+
     Args:
-        limit: Maximum number of songs to return (default: 100)
+        limit: Maximum number of songs to return (default: 100, max: 1000)
+        before: Only return songs older than this cursor (see parse_before)
 
     Returns:
         JSON array of songs
     """
-    try:
-        return query_songs(limit)
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=str(e))
+    # Only the latest pages are cached: arbitrary ?before= cursors are rarely
+    # requested twice. Keying on the ETag keeps cached bodies in step with
+    # the tag they're sent with.
+    page = cache_get(("/json", limit, etag)) if before is None else None
+    if page is None:
+        try:
+            page = await query_songs_dicts(db, limit, before)
+        except Exception as e:
+            raise HTTPException(status_code=500, detail=str(e))
+
+        if before is None:
+            cache_set(("/json", limit, etag), page)
+
+    data, next_before = page
+    response.headers["Cache-Control"] = CACHE_CONTROL
+    response.headers["ETag"] = etag
+    if next_before is not None:
+        response.headers["X-Next-Before"] = next_before
+    return data
 
 
 @app.get("/stats")
-def get_stats():
+async def get_stats(response: Response, db: aiosqlite.Connection = Depends(get_db)):
     """Get database statistics
 
     Returns:
         Statistics about the music database
     """
-    try:
-        conn = get_db_connection()
-        cursor = conn.cursor()
-
-        # Total songs
-        cursor.execute("SELECT COUNT(*) FROM songs")
-        total_songs = cursor.fetchone()[0]
-
-        # Unique songs
-        cursor.execute("SELECT COUNT(DISTINCT title || artist) FROM songs")
-        unique_songs = cursor.fetchone()[0]
-
-        # Most recent detection
-        cursor.execute("SELECT datetime(MAX(timestamp), 'localtime') FROM songs")
-        last_detection = cursor.fetchone()[0]
+    response.headers["Cache-Control"] = CACHE_CONTROL
+    stats = cache_get(("/stats",))
+    if stats is not None:
+        return stats
 
-        # Most detected song
-        cursor.execute(
-            """
-            SELECT title, artist, COUNT(*) as count
-            FROM songs
-            GROUP BY title, artist
-            ORDER BY count DESC
-            LIMIT 1
-            """
-        )
-        top_song = cursor.fetchone()
-
-        conn.close()
+    try:
+        # Totals, last detection and most detected song in a single statement
+        async with db.execute(STATS_SQL) as cursor:
+            total_songs, unique_songs, last_detection, top_title, top_artist, top_count = await cursor.fetchone()
 
-        return {
+        stats = {
             "total_detections": total_songs,
             "unique_songs": unique_songs,
             "last_detection": last_detection,
             "most_detected": {
-                "title": top_song[0] if top_song else None,
-                "artist": top_song[1] if top_song else None,
-                "count": top_song[2] if top_song else 0
+                "title": top_title,
+                "artist": top_artist,
+                "count": top_count or 0
             }
         }
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
+    cache_set(("/stats",), stats)
+    return stats
+
+
+# Templates are compiled once at import; autoescaping covers track metadata
+templates = jinja2.Environment(
+    loader=jinja2.FileSystemLoader(os.path.join(BASE_DIR, "templates")),
+    autoescape=True,
+    enable_async=True,
+    trim_blocks=True,
+    lstrip_blocks=True
+)
+table_template = templates.get_template("table.html")
+
 
 @app.get("/table")
-def get_music_table(limit: int = 100):
+async def get_music_table(
+    limit: int = Query(100, ge=1, le=MAX_LIMIT),
+    db: aiosqlite.Connection = Depends(get_db),
+    etag: str = Depends(check_etag)
+):
     """Get music data as cyberpunk-styled HTML table
 
+    The page is rendered from templates/table.html and streamed in chunks.
+    Rows are fetched up front (limit is capped) so the cursor is closed
+    before streaming: an unfinished statement would hold the shared
+    connection's read snapshot open for as long as a slow client reads,
+    leaving every other request on this worker with stale data.
+
     Args:
-        limit: Maximum number of songs to return (default: 100)
+        limit: Maximum number of songs to return (default: 100, max: 1000)
 
     Returns:
         HTML page with song data in a table
     """
+    headers = {"Cache-Control": CACHE_CONTROL, "ETag": etag}
+    html = cache_get(("/table", limit, etag))
+    if html is not None:
+        return Response(content=html, media_type="text/html", headers=headers)
+
     try:
-        data = query_songs(limit)
+        rows = await query_songs_tuples(db, limit)
     except Exception as e:
-        return Response(
-            content=f"<html><body><h1>Error</h1><p>{html_module.escape(str(e))}</p></body></html>",
-            media_type="text/html"
-        )
-
-    # Create HTML table
-    html = """
-    <!DOCTYPE html>
-    <html>
-    <head>
-        <title>Shamon - Music Data</title>
-        <meta charset="utf-8">
-        <meta name="viewport" content="width=device-width, initial-scale=1">
-        <style>
-            body {
-                background-color: #0a0a0f;
-                color: #00ff66;
-                font-family: 'Courier New', monospace;
-                margin: 0;
-                padding: 20px;
-            }
-            .header {
-                margin-bottom: 30px;
-            }
-            h1 {
-                color: #ff00aa;
-                text-shadow: 0 0 5px #ff00aa, 0 0 10px #ff00aa;
-                text-transform: uppercase;
-                letter-spacing: 2px;
-                margin-bottom: 10px;
-            }
-            .stats {
-                color: #00ccff;
-                margin-bottom: 20px;
-            }
-            table {
-                border-collapse: collapse;
-                width: 100%;
-                background-color: rgba(10, 10, 15, 0.8);
-                border: 1px solid #00ccff;
-                box-shadow: 0 0 15px #00ccff;
-            }
-            th, td {
-                text-align: left;
-                padding: 10px;
-                border: 1px solid #00ccff;
-            }
-            tr:nth-child(even) {
-                background-color: rgba(0, 204, 255, 0.1);
-            }
-            tr:hover {
-                background-color: rgba(255, 0, 170, 0.2);
-            }
-            th {
-                background-color: #000033;
-                color: #00ff66;
-                text-transform: uppercase;
-                border-bottom: 2px solid #ff00aa;
-                position: sticky;
-                top: 0;
-            }
-            .no-data {
-                text-align: center;
-                padding: 40px;
-                color: #ff00aa;
-            }
-            .footer {
-                margin-top: 20px;
-                text-align: center;
-                color: #666;
-                font-size: 0.9em;
-            }
-        </style>
-    </head>
-    <body>
-        <div class="header">
-            <h1>📻 Shamon Music Monitor</h1>
-            <div class="stats">Database: """ + DB_PATH + """</div>
-        </div>
-    """
+        raise HTTPException(status_code=500, detail=str(e))
 
-    if data:
-        html += """
-        <table>
-            <tr>
-                <th>Timestamp</th>
-                <th>Title</th>
-                <th>Artist</th>
-                <th>Audio Level</th>
-            </tr>
-        """
-
-        # Add table rows (escape HTML to prevent XSS)
-        for item in data:
-            timestamp = html_module.escape(str(item.get("timestamp", "")))
-            title = html_module.escape(str(item.get("title", "")))
-            artist = html_module.escape(str(item.get("artist", "")))
-            audio_level = item.get("audio_level", "")
-
-            html += f"""
-            <tr>
-                <td>{timestamp}</td>
-                <td>{title}</td>
-                <td>{artist}</td>
-                <td>{audio_level}</td>
-            </tr>
-            """
+    async def render() -> AsyncIterator[str]:
+        """Yield the page in chunks, keeping a copy for the response cache"""
+        parts = []
+        async for chunk in table_template.generate_async(data=rows, db_path=DB_PATH):
+            parts.append(chunk)
+            yield chunk
 
-        html += "</table>"
-    else:
-        html += """
-        <div class="no-data">
-            <p>No music data found. Run shamon.sh to start monitoring.</p>
-        </div>
-        """
-
-    html += """
-        <div class="footer">
-            Shamon v1.2.3 | Showing last """ + str(len(data)) + """ detections
-        </div>
-    </body>
-    </html>
-    """
+        cache_set(("/table", limit, etag), "".join(parts))
 
-    return Response(content=html, media_type="text/html")
+    return StreamingResponse(render(), media_type="text/html", headers=headers)
 
 
 if __name__ == "__main__":
@@ -295,4 +514,15 @@ if __name__ == "__main__":
     print("   - Statistics: http://localhost:8080/stats")
     print("\nPress Ctrl+C to stop")
 
-    uvicorn.run(app, host="0.0.0.0", port=8080)
+    # Each worker process opens its own SQLite connection in lifespan(),
+    # which WAL mode lets read concurrently
+    uvicorn.run(
+        "serve:app",
+        app_dir=BASE_DIR,
+        host="0.0.0.0",
+        port=8080,
+        workers=min(4, os.cpu_count() or 1),
+        loop="uvloop",
+        http="httptools",
+        log_level="warning"
+    )